@@ -2,9 +2,13 @@ from queue import Queue, Empty
 import serial
 import serial.tools.list_ports
 from PyQt5.QtWidgets import QMessageBox, QApplication, QLayout, QComboBox, QGridLayout, QHBoxLayout, QVBoxLayout, QWidget,QMainWindow, QPushButton
-from PyQt5.QtCore import QObject, pyqtSignal, QThread, QTimer
-from relay_config import load_config
-from protocol_conrad import ConradRelayCard
+from PyQt5.QtCore import QObject, pyqtSignal, QThread
+from relay_config import load_config, build_group_index, resolve_targets
+from protocol_conrad import ConradRelayCard, flags_to_byte, byte_to_flags
+from relay_cycles import RelayCycleStore
+from serial_multiplexer import SerialMultiplexer, Priority
+from relay_process import RelayProcessClient
+import multiprocessing
 import logging
 import math
 
@@ -44,41 +48,26 @@ class RelaySwitcherWorker(QObject):
     work_ongoing = pyqtSignal()
     work_done = pyqtSignal()
 
-    def __init__(self: QObject, relay_card, queue_relay_state:Queue, queue_gui_update:Queue) -> None:
+    def __init__(self: QObject, multiplexer) -> None:
         super().__init__()
         self.interrupt_requested = False
-        self.queue_relay_state = queue_relay_state
-        self.queue_gui_update = queue_gui_update
-        self.relay_card = relay_card
+        self.multiplexer = multiplexer
 
 
     def _interrupt_worker(self):
         self.interrupt_requested = True
 
     def run(self):
-        while not self.interrupt_requested:
-            try:
-                state_flags, additional_wait_time = self.queue_relay_state.get(timeout=1.0)
-                
-                log.debug(f"RelaySwitcherWorker: Requested state {state_flags}")
-                new_state_flags = self.relay_card.hacky_set_relays(card_id=0, relay_flags_bool=state_flags)
-                
-                self.queue_gui_update.put(new_state_flags)
-
-                log.debug(f"additional_wait_time: {additional_wait_time}", )
-                QThread.msleep(additional_wait_time)
-
-
-            except Empty:
-                log.debug("RelaySwitcherWorker: No updates")
-
-            except Exception as e:
-                log.error(str(e))
+        # this thread is the only one touching the serial link, everything else submits to the multiplexer.
+        # with a separate io process it only collects the replies.
+        self.multiplexer.serve(interrupt_requested=lambda: self.interrupt_requested)
 
         self.finished.emit()
 
 
 class RelayWindow(QWidget):
+    pulse_finished = pyqtSignal()
+    card_state_stored = pyqtSignal()
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
@@ -90,7 +79,18 @@ class RelayWindow(QWidget):
         self.setup_relay_layout(config)
 
         self.selected_com_port = None
-        self.relay_card = ConradRelayCard()
+        self.card_states = {} # last confirmed byte of every card besides the displayed card 0
+        self.reported_port_members = set()
+        self.cycle_limit_warned = set()
+
+        if config.get("io_process"):
+            self.multiplexer = RelayProcessClient(cycle_limit=config.get("cycle_limit"))
+            self.cycle_store = self.multiplexer.cycle_store
+        else:
+            self.cycle_store = self._load_cycle_store(config)
+            self.relay_card = ConradRelayCard(cycle_store=self.cycle_store)
+            self.multiplexer = SerialMultiplexer(self.relay_card)
+        self.workers_started = False
 
         # gui updater
         self.queue_update_gui = Queue()
@@ -104,8 +104,7 @@ class RelayWindow(QWidget):
         self.gui_update_worker.state_change.connect(self._update_relay_button_representation)
         
         # relay networker
-        self.queue_update_relay = Queue()
-        self.relay_update_worker = RelaySwitcherWorker(relay_card=self.relay_card, queue_relay_state=self.queue_update_relay, queue_gui_update=self.queue_update_gui)
+        self.relay_update_worker = RelaySwitcherWorker(multiplexer=self.multiplexer)
         self.relay_update_thread = QThread()
         self.relay_update_worker.moveToThread(self.relay_update_thread)
         self.relay_update_thread.started.connect(self.relay_update_worker.run)
@@ -113,28 +112,45 @@ class RelayWindow(QWidget):
         self.relay_update_worker.finished.connect(self.relay_update_worker.deleteLater)
         self.relay_update_thread.finished.connect(self.relay_update_thread.deleteLater)
 
+        self.pulse_finished.connect(self._enable_relay_buttons)
+        self.card_state_stored.connect(self._update_cycle_representation)
+
         # initial state
         self.current_state = [False, False, False, False, False, False, False, False]
 
 
     def _load_relay_config(self):
         try:
-            return load_config(allow_write=True)
+            config = load_config(allow_write=True)
+
+            # resolve every button to per card bitmasks once, a click is then one OR / AND-NOT per card
+            group_index = build_group_index(config)
+            self.button_masks = [resolve_targets(b.get("targets"), group_index) for b in config.get("buttons")]
+
+            return config
         
         except Exception as e:
             _make_error_window(e, kill_process=True, headline="Error Parsing Relay Config", popup_title="Relay Config Error")
 
+    def _load_cycle_store(self, config):
+        try:
+            return RelayCycleStore(limit=config.get("cycle_limit")).load()
+
+        except Exception as e:
+            _make_error_window(e, kill_process=True, headline="Error Reading Cycle Counters", popup_title="Cycle Counter Error")
+
     def _factorize_special_buttons(self, config, parent_widget, logical_container=[]):
         config_buttons = config.get("buttons")[:__max_special_buttons__]
 
         x = 0
         y = 0
-        for b in config_buttons:
+        for b, masks in zip(config_buttons, self.button_masks):
             log.debug(str(b))
             button_temp = QPushButton(b.get("label")[:__max_label_length__])
             button_temp.custom_action = b.get("action")
-            button_temp.custom_targets = b.get("targets")
+            button_temp.custom_masks = masks
             button_temp.custom_duration = b.get("duration")
+            button_temp.custom_emergency = b.get("action") == "deactivate" and masks.get((None, 0)) == 0xff
             button_temp.clicked.connect(self.special_action)
             parent_widget.addWidget(button_temp, y, x % 4)
             logical_container.append(button_temp)
@@ -148,18 +164,18 @@ class RelayWindow(QWidget):
         custom_action = event_cause.custom_action
 
         if custom_action == "activate":
-            self.action_activate_selective(event_cause.custom_targets)
+            self.action_activate_selective(event_cause.custom_masks)
         elif custom_action == "deactivate":
-            self.action_disable_selective(event_cause.custom_targets)
+            self.action_disable_selective(event_cause.custom_masks, emergency=event_cause.custom_emergency)
         elif custom_action == "pulse":
             duration = 500
             if event_cause.custom_duration:
                 duration = event_cause.custom_duration
 
-            self.action_pulse_selective(event_cause.custom_targets, duration=duration)
+            self.action_pulse_selective(event_cause.custom_masks, duration=duration)
         else:
             _make_error_window(Exception("Unknown special button action. Cannot perform"), kill_process=False)
-        
+
     def boring_old_button_action(self):
         event_cause = self.sender() # event cause
         card_id = 0
@@ -171,8 +187,60 @@ class RelayWindow(QWidget):
 
         # toggle
         state[relay_index] = not state[relay_index]
-        self.queue_update_relay.put( (state, 0) )
+        self._submit_relay_state(state)
+
+
+    def _submit_relay_state(self, state, priority=Priority.NORMAL):
+        return self._submit_card_state(0, flags_to_byte(state), priority=priority)
+
+    def _submit_card_state(self, card_id, relay_flags, priority=Priority.NORMAL):
+        future = self.multiplexer.set_relays(card_id=card_id, relay_flags=relay_flags, priority=priority)
+        return self._track_card_response(card_id, future)
+
+    def _track_card_response(self, card_id, future):
+        future.add_done_callback(lambda f: self._on_relay_response(card_id, f))
+        return future
+
+    def _on_relay_response(self, card_id, future):
+        # runs in the multiplexer thread, hand the result over to the gui updater
+        if future.cancelled():
+            log.info("Relay request cancelled")
+            return
+
+        e = future.exception()
+        if e is not None:
+            log.error(str(e))
+            return
+
+        self._store_card_state(card_id, future.result())
+
+    def _store_card_state(self, card_id, response):
+        relay_flags = response.get_data()
 
+        # the io process publishes confirmed states to shared memory before it replies
+        if isinstance(self.multiplexer, RelayProcessClient):
+            shared_flags = self.multiplexer.read_state(card_id)
+            if shared_flags is not None:
+                relay_flags = shared_flags
+
+        if card_id == 0:
+            self.queue_update_gui.put(byte_to_flags(relay_flags))
+        else:
+            self.card_states[card_id] = relay_flags
+            self.card_state_stored.emit()
+
+    def _on_pulse_done(self, card_ids, future):
+        # runs in the multiplexer thread as well, buttons come back through a queued signal
+        if future.cancelled():
+            log.info("Pulse cancelled")
+        elif future.exception() is not None:
+            log.error(str(future.exception()))
+        else:
+            for card_id, report in zip(card_ids, future.result()):
+                log.info(str(report))
+                self._store_card_state(card_id, report.off_response)
+
+        self.pulse_finished.emit()
 
     def _update_relay_button_representation(self, flags: list[bool]):
         if len(self.relay_buttons) != len(flags):
@@ -185,6 +253,29 @@ class RelayWindow(QWidget):
                 self._display_button_disabled(btn)
 
         self.current_state = flags
+        self._update_cycle_representation()
+
+    def _update_cycle_representation(self):
+        cycles = self.cycle_store.cycles(card_id=0)
+        over_limit = self.cycle_store.over_limit(card_id=0)
+
+        for i, btn in enumerate(self.relay_buttons):
+            tooltip = f"Switch cycles: {cycles[i]}"
+            if over_limit[i]:
+                tooltip += f" (limit {self.cycle_store.limit} reached)"
+            btn.setToolTip(tooltip)
+
+        # every card with a confirmed state, each relay once per session
+        reached = []
+        for card_id in [0] + sorted(self.card_states):
+            cycles = self.cycle_store.cycles(card_id=card_id)
+            for i, over in enumerate(self.cycle_store.over_limit(card_id=card_id)):
+                if over and (card_id, i) not in self.cycle_limit_warned:
+                    self.cycle_limit_warned.add((card_id, i))
+                    reached.append(f"Card {card_id} relay {i + 1}: {cycles[i]} switch cycles")
+
+        if len(reached) > 0:
+            QMessageBox.warning(self, "Cycle Limit", f"Limit of {self.cycle_store.limit} switch cycles reached:\n\n" + "\n".join(reached))
 
 
     def _display_button_enabled(self, btn):
@@ -213,43 +304,60 @@ class RelayWindow(QWidget):
         btn.setStyleSheet(btn.default_stylesheet)
 
 
-    def action_activate_selective(self, targets=[]):
-        state = self.current_state.copy()
-        targets = list(dict.fromkeys(targets))
-        
-        for t in targets:
-            if (t - 1) < len(state):
-                state[t - 1] = True
+    def _connected_card_masks(self, masks):
+        """Reduces {(port, card): bitmask} to {card: bitmask} of the connected port"""
+        card_masks = {}
 
-        self.queue_update_relay.put((state, 0))
+        for (port, card_id), mask in masks.items():
+            if port is not None and port != self.selected_com_port:
+                log.info(f"Port {port} is not connected, skipping card {card_id}")
+                continue
+            card_masks[card_id] = card_masks.get(card_id, 0) | mask
 
+        return card_masks
 
-    def action_disable_selective(self, targets=[]):
-        state = self.current_state.copy()
-        targets = list(dict.fromkeys(targets))
-        
-        for t in targets:
-            if (t - 1) < len(state):
-                state[t - 1] = False
+    def _warn_other_port_members(self):
+        # the gui drives a single port, group members elsewhere are reported once, not switched
+        skipped = set()
+        for masks in self.button_masks:
+            skipped.update((port, card_id) for port, card_id in masks if port is not None and port != self.selected_com_port)
 
-        self.queue_update_relay.put((state, 0))
+        skipped -= self.reported_port_members
+        self.reported_port_members |= skipped
+        if len(skipped) == 0:
+            return
 
-    def action_pulse_selective(self, targets=[], duration=500):
-        state_a = self.current_state.copy()
-        state_b = state_a.copy()
+        skipped = [f"{port} card {card_id}" for port, card_id in sorted(skipped)]
 
-        for t in targets:
-            if (t - 1) < len(state_a):
-                state_a[t - 1] = True
-                state_b[t - 1] = False
+        log.warning(f"Skipping group members on ports that are not connected: {', '.join(skipped)}")
+        QMessageBox.warning(self, "Group Members Skipped", "These group members are on ports that are not connected and will not be switched:\n\n" + "\n".join(skipped))
 
-        self.queue_update_relay.put( (state_a, duration) )
-        self.queue_update_relay.put( (state_b, 0) )
+    # the card applies OR (SETSINGLE) and AND-NOT (DELSINGLE) itself, so no
+    # click is computed from a cached byte that may be stale or unknown
+    def action_activate_selective(self, masks={}):
+        for card_id, mask in self._connected_card_masks(masks).items():
+            self._track_card_response(card_id, self.multiplexer.enable_relays(card_id=card_id, relay_flags=mask))
 
-        self._disable_relay_buttons()
-        self.timer = QTimer()
-        self.timer.timeout.connect(self._enable_relay_buttons)
-        self.timer.start(duration + 200)
+
+    def action_disable_selective(self, masks={}, emergency=False):
+        # only the real all off button jumps the queue and drops everything still pending
+        priority = Priority.NORMAL
+        if emergency:
+            priority = Priority.EMERGENCY
+
+        for card_id, mask in self._connected_card_masks(masks).items():
+            self._track_card_response(card_id, self.multiplexer.disable_relays(card_id=card_id, relay_flags=mask, priority=priority))
+
+    def action_pulse_selective(self, masks={}, duration=500):
+        card_masks = self._connected_card_masks(masks)
+        future = self.multiplexer.pulse_masks(card_masks, duration_ms=duration)
+
+        for i, btn in enumerate(self.relay_buttons):
+            if card_masks.get(0, 0) & (1 << i):
+                self._display_button_limbo(btn)
+
+        self._disable_relay_buttons(keep_emergency=True)
+        future.add_done_callback(lambda f: self._on_pulse_done(list(card_masks), f))
 
 
     def list_ports(self):
@@ -270,8 +378,11 @@ class RelayWindow(QWidget):
 
         return port_names
 
-    def _set_buttons_enabled(self, state=True):
+    def _set_buttons_enabled(self, state=True, keep_emergency=False):
         for b in self.meta_buttons:
+            if keep_emergency and b.custom_emergency:
+                b.setEnabled(True)
+                continue
             b.setEnabled(state)
 
         for b in self.relay_buttons:
@@ -280,8 +391,16 @@ class RelayWindow(QWidget):
     def _enable_relay_buttons(self):
         self._set_buttons_enabled(state=True)
 
-    def _disable_relay_buttons(self):
-        self._set_buttons_enabled(state=False)
+    def _disable_relay_buttons(self, keep_emergency=False):
+        self._set_buttons_enabled(state=False, keep_emergency=keep_emergency)
+
+    def _start_workers(self):
+        if self.workers_started:
+            return
+
+        self.gui_update_thread.start()
+        self.relay_update_thread.start()
+        self.workers_started = True
 
     def _connect_relay_card(self):
         #self.selected_com_port = self.combobox_ports.currentText()
@@ -291,26 +410,50 @@ class RelayWindow(QWidget):
             pass
 
         try:
-            self.relay_card.connect(self.selected_com_port)
-            pre_state = self.relay_card.check_relay_state()
-            self.queue_update_gui.put(pre_state)
-            self._enable_relay_buttons()
+            # thread start first, the io process client only reads its connect reply while serving
+            self._start_workers()
 
-            # thread start
-            self.gui_update_thread.start()
-            self.relay_update_thread.start()
+            self.multiplexer.connect(self.selected_com_port)
+
+            pre_state = self.multiplexer.check_relay_state().result(timeout=5.0)
+            self.queue_update_gui.put(pre_state.get_data_flags())
+            self._read_group_card_states()
+            self._enable_relay_buttons()
 
             self.connect_button.setEnabled(False)
+            self._warn_other_port_members()
 
         except ConnectionError as ce:
             log.error(str(ce))
             _make_error_window(ConnectionError("Could not connect to Relay Card. Is the card powered?"), kill_process=False, headline="Error", popup_title="Connection Error")
-            self.relay_card.shutdown()
+            self._disconnect_quietly()
         
         except Exception as e:
             log.error(str(e))
             _make_error_window(e, kill_process=False, headline="Error", popup_title="Connection Error")
-            self.relay_card.shutdown()
+            self._disconnect_quietly()
+
+    def _disconnect_quietly(self):
+        # runs in a Qt slot, nothing may escape from here
+        try:
+            self.multiplexer.disconnect()
+        except Exception as e:
+            log.error(f"Could not disconnect: {e}")
+
+    def _read_group_card_states(self):
+        card_ids = set()
+        for masks in self.button_masks:
+            card_ids.update(self._connected_card_masks(masks))
+        card_ids.discard(0)
+
+        for card_id in sorted(card_ids):
+            future = self.multiplexer.check_relay_state(card_id=card_id)
+            future.add_done_callback(lambda f, c=card_id: self._on_relay_response(c, f))
+
+    def shutdown(self):
+        log.info(f"Pulse timing error: {self.multiplexer.pulse_stats}")
+        self.multiplexer.shutdown()
+        self.cycle_store.flush()
 
 
 
@@ -385,6 +528,10 @@ class RelayMainWindow(QMainWindow):
         self.form_widget = RelayWindow() 
         self.setCentralWidget(self.form_widget)
 
+    def closeEvent(self, event):
+        self.form_widget.shutdown()
+        super().closeEvent(event)
+
 def _make_error_window(e, kill_process=False, headline="Error", popup_title="Error"):
     msg = QMessageBox()
     msg.setIcon(QMessageBox.Critical)
@@ -412,4 +559,6 @@ def main():
         log.error(str(e))
         _make_error_window(e, kill_process=True, headline="Critical Application Error", popup_title="Critical Error")
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # io process in PyInstaller builds
+    main()
\ No newline at end of file
@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 import serial # pip install pyserial
 import time
+import threading
 import logging
 __author__="Robert Detlof"
 
 log = logging.getLogger("Protocol Conrad")
 
+BAUDRATE = 19200
+FRAME_SIZE = 4 # command, address, data, checksum
+SETTLE_TIME = 0.1 # seconds of silence after every response, before the next request
+RECONNECT_DELAY = 0.1 # first backoff step in seconds, doubled up to RECONNECT_MAX_DELAY
+RECONNECT_MAX_DELAY = 2.0
+
+
+def frame_round_trip_time(baudrate=BAUDRATE):
+    """Seconds one request plus its response occupy the line (8N1, 10 bits per byte)"""
+    return 2 * FRAME_SIZE * 10 / baudrate
+
 class CommandCodes:
     NOOP = 0
     SETUP = 1
@@ -45,6 +57,10 @@ class ResponseCodes:
     TOGGLE = 247
 
 
+# responses to these commands carry the port state of the card
+STATE_COMMANDS = (CommandCodes.GETPORT, CommandCodes.SETPORT, CommandCodes.SETSINGLE, CommandCodes.DELSINGLE, CommandCodes.TOGGLE)
+
+
 def byte_to_flags(val: int):
 
     if val < 0 or val > 255:
@@ -114,8 +130,15 @@ class ConradSerialFrame:
 
 class ConradRelayCard:
 
-    def __init__(self) -> None:
+    def __init__(self, cycle_store=None, reconnect_timeout=30.0) -> None:
         self.connection = None
+        self.port = None
+        self.cycle_store = cycle_store
+        self.reconnect_timeout = reconnect_timeout # None disables reconnecting
+        self.desired_state = {} # card id -> byte the card should be at, only for cards that answered before
+        self.last_outage = None # seconds from link loss to confirmed restore
+        self._lock = threading.RLock()
+        self._quiet_until = 0.0
 
 
     def hacky_set_relays(self, card_id=0, relay_flags_bool=[]):
@@ -140,39 +163,176 @@ class ConradRelayCard:
         return self._communicate(request_frame)
     
     def _communicate(self, request_frame):
+        with self._lock:
+            lost_at = time.monotonic()
+            try:
+                return self._communicate_locked(request_frame)
+
+            except ConnectionError:
+                # card did not answer, the link itself is fine
+                raise
+
+            except serial.SerialException as e:
+                if self.port is None or self.reconnect_timeout is None:
+                    raise
+
+                log.error(f"Serial link lost: {e}")
+                restored = self._reconnect(lost_at)
+                return self._answer_after_restore(request_frame, restored)
+
+    def _answer_after_restore(self, request_frame, restored):
+        """
+        The restore already applied the interrupted request through the
+        desired state, so it is answered from the confirming GETPORT instead
+        of being sent (and e.g. toggled) a second time.
+        """
+        card_id = request_frame.address[0]
+
+        if request_frame.get_command() in STATE_COMMANDS and card_id in restored:
+            confirmed = restored[card_id]
+            response_frame = ConradSerialFrame(255 - request_frame.get_command(), card_id, confirmed.get_data())
+            response_frame.sent_at = confirmed.sent_at
+            response_frame.received_at = confirmed.received_at
+            return response_frame
+
+        # not covered by the restore, its desired state change is already applied
+        return self._communicate_locked(request_frame, update_desired=False)
+
+    def _reconnect(self, lost_at):
+        delay = RECONNECT_DELAY
+        attempt = 0
+
+        while True:
+            attempt += 1
+            if self.connection != None:
+                try:
+                    self.connection.close()
+                except Exception as e:
+                    log.debug(f"closing lost connection: {e}")
+
+            try:
+                self.connect(self.port)
+                restored = self._restore_desired_state()
+                break
+
+            except OSError as e: # SerialException and ConnectionError
+                if time.monotonic() + delay - lost_at > self.reconnect_timeout:
+                    raise ConnectionError(f"Could not reconnect to {self.port} within {self.reconnect_timeout} s")
+
+                log.warning(f"Reconnect attempt {attempt} failed: {e}, retrying in {delay:.1f} s")
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        self.last_outage = time.monotonic() - lost_at
+        log.warning(f"Reconnected to {self.port} after {attempt} attempt(s), outage {self.last_outage * 1000:.0f} ms")
+
+        return restored
+
+    def _restore_desired_state(self):
+        """Returns the confirming GETPORT response of every restored card"""
+        restored = {}
+
+        # a lost link aborts the restore, a single silent or disagreeing card does not
+        for card_id, relay_flags in list(self.desired_state.items()):
+            try:
+                self._communicate_locked(ConradSerialFrame(CommandCodes.SETPORT, card_id, relay_flags))
+
+                response = self._communicate_locked(ConradSerialFrame(CommandCodes.GETPORT, card_id, 0))
+                if response.get_data() != relay_flags:
+                    raise ConnectionError(f"Card {card_id} reports {hex(response.get_data())} after restoring {hex(relay_flags)}")
+
+            except ConnectionError as e:
+                log.error(f"Could not restore card {card_id}: {e}")
+                continue
+
+            restored[card_id] = response
+            log.info(f"Restored card {card_id} to {hex(relay_flags)}")
+
+        return restored
+
+    def _update_desired_state(self, request_frame):
+        card_id = request_frame.address[0]
+        command = request_frame.get_command()
+        data = request_frame.get_data()
+
+        # cards enter desired_state with their first confirmed response
+        if card_id not in self.desired_state:
+            return
+
+        if command == CommandCodes.SETPORT:
+            self.desired_state[card_id] = data
+        elif command == CommandCodes.SETSINGLE:
+            self.desired_state[card_id] |= data
+        elif command == CommandCodes.DELSINGLE:
+            self.desired_state[card_id] &= ~data & 0xff
+        elif command == CommandCodes.TOGGLE:
+            self.desired_state[card_id] ^= data
+
+    def _communicate_locked(self, request_frame, update_desired=True):
+        """
+        The returned response frame carries sent_at and received_at
+        (time.monotonic) of the request write and the complete response.
+        """
         if self.connection == None or not self.connection.is_open:
-            raise Exception("Could not open serial connection")
-        
+            raise serial.SerialException("Could not open serial connection")
+
+        # a request counts as wanted even if the link drops before the response
+        if update_desired:
+            self._update_desired_state(request_frame)
+
+        # settle time is only waited for when the next request comes in too early
+        delay = self._quiet_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
         self.connection.reset_input_buffer()
         self.connection.reset_output_buffer()
 
         log.info(f"[REQUEST] {str(request_frame)}")
 
+        sent_at = time.monotonic()
         self.connection.write(request_frame.get_bytes())
 
 
-        last_read = bytearray(self.connection.read(size=4))
+        last_read = bytearray(self.connection.read(size=FRAME_SIZE))
 
         while len(last_read) > 0 and last_read[0] < 0xf0:
             log.debug(f"discarding: {last_read}")
-            last_read = bytearray(self.connection.read(size=4))
+            last_read = bytearray(self.connection.read(size=FRAME_SIZE))
+
+        received_at = time.monotonic()
+        self._quiet_until = received_at + SETTLE_TIME
 
         log.debug(f"last_read: {last_read}")
 
         response_frame_raw = bytearray(last_read)
 
-        if len(response_frame_raw) < 4:
+        if len(response_frame_raw) < FRAME_SIZE:
             raise ConnectionError("Response truncated")
         
         response_frame = ConradSerialFrame(response_frame_raw[0], response_frame_raw[1], response_frame_raw[2])
+        response_frame.sent_at = sent_at
+        response_frame.received_at = received_at
         
         log.info(f"[RESPONSE] {response_frame}")
 
-        time.sleep(.1)
+        self._record_state(request_frame, response_frame)
+
+        if request_frame.get_command() in STATE_COMMANDS and (255 - response_frame.get_command()) == request_frame.get_command():
+            self.desired_state[request_frame.address[0]] = response_frame.get_data()
 
         return response_frame
     
 
+    def _record_state(self, request_frame, response_frame):
+        if self.cycle_store is None or request_frame.get_command() not in STATE_COMMANDS:
+            return
+
+        if (255 - response_frame.get_command()) != request_frame.get_command():
+            return
+
+        self.cycle_store.record(request_frame.address[0], response_frame.get_data())
+
     def enable_relay_by_index(self, card_id, index):
         flag_int = index_to_byte_mask(index)
         return self._enable_single_relay(card_id, flag_int)
@@ -225,7 +385,7 @@ class ConradRelayCard:
 
         self.connection = serial.Serial(
             port,
-            baudrate=19200,
+            baudrate=BAUDRATE,
             parity=serial.PARITY_NONE,
             bytesize=serial.EIGHTBITS,
             stopbits=serial.STOPBITS_ONE,
@@ -244,7 +404,13 @@ class ConradRelayCard:
         self.connection.reset_input_buffer()
         self.connection.reset_output_buffer()
 
+        self.port = port
+
 
     def shutdown(self):
+        self.port = None # deliberate, no reconnect
         if self.connection != None:
-            self.connection.close()
\ No newline at end of file
+            self.connection.close()
+
+        if self.cycle_store is not None:
+            self.cycle_store.flush()
\ No newline at end of file
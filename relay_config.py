@@ -36,9 +36,16 @@ CONFIG_SCHEMA = {
                         "minItems": 1,
                         "maxItems": 128,
                         "items": {
-                            "type": "integer",
-                            "minimum": 1,
-                            "maximum": 8
+                            "anyOf": [
+                                {
+                                    "type": "integer",
+                                    "minimum": 1,
+                                    "maximum": 8
+                                },
+                                {
+                                    "type": "string"
+                                }
+                            ]
                         }
                     },
                     "duration": {
@@ -48,6 +55,41 @@ CONFIG_SCHEMA = {
                     }
                 }
             }
+        },
+        "groups": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "required": ["relays"],
+                    "properties": {
+                        "port": {"type": "string"},
+                        "card": {
+                            "type": "integer",
+                            "minimum": 0,
+                            "maximum": 255
+                        },
+                        "relays": {
+                            "type": "array",
+                            "minItems": 1,
+                            "items": {
+                                "type": "integer",
+                                "minimum": 1,
+                                "maximum": 8
+                            }
+                        }
+                    }
+                }
+            }
+        },
+        "cycle_limit": {
+            "type": "integer",
+            "minimum": 1
+        },
+        "io_process": {
+            "type": "boolean"
         }
     }   
 }
@@ -102,6 +144,45 @@ def parse_json(text_content):
 def dict_to_json(dict_content, indent=2):
     return json.dumps(dict_content, indent=indent)
 
+def _relays_to_mask(relays):
+    mask = 0
+    for r in relays:
+        mask |= 1 << (r - 1)
+    return mask
+
+def _merge_masks(target, masks):
+    for key, mask in masks.items():
+        target[key] = target.get(key, 0) | mask
+
+def build_group_index(config):
+    """
+    Maps every group name to {(port, card): bitmask}. A port of None stands
+    for the port the tool is connected to.
+    """
+    index = {}
+
+    for name, members in config.get("groups", {}).items():
+        masks = {}
+        for m in members:
+            _merge_masks(masks, {(m.get("port"), m.get("card", 0)): _relays_to_mask(m.get("relays"))})
+        index[name] = masks
+
+    return index
+
+def resolve_targets(targets, group_index):
+    """Merges button targets (relay numbers of card 0 and group names) into {(port, card): bitmask}"""
+    masks = {}
+
+    for t in targets:
+        if isinstance(t, str):
+            if t not in group_index:
+                raise Exception(f"Unknown relay group \"{t}\"")
+            _merge_masks(masks, group_index[t])
+        else:
+            _merge_masks(masks, {(None, 0): _relays_to_mask([t])})
+
+    return masks
+
 def load_config(allow_write=True):
     path_cwd = Path.cwd()
     path_config = path_cwd.joinpath(CONFIG_NAME)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+from array import array
+from pathlib import Path
+import argparse
+import json
+import os
+import tempfile
+import time
+import logging
+__author__="Robert Detlof"
+
+log = logging.getLogger("Relay Cycles")
+
+CYCLES_NAME = "relay_cycles.json"
+MAX_CARDS = 256
+RELAYS_PER_CARD = 8
+
+
+class RelayCycleStore:
+    """
+    Per-relay rising/falling edge counters for up to 256 card addresses.
+
+    Edges are derived from consecutive confirmed state bytes of a card
+    (previous XOR current), so only relays that actually switched are touched.
+    The counters are written to disk every flush_interval seconds at most,
+    always via a temporary file and os.replace.
+
+    rising/falling may be passed in as any writable buffer of unsigned 64 bit
+    counters (e.g. a cast memoryview of shared memory) instead of the
+    default private arrays.
+    """
+
+    def __init__(self, path=None, flush_interval=30.0, limit=None, rising=None, falling=None) -> None:
+        self.path = Path(path) if path is not None else Path.cwd().joinpath(CYCLES_NAME)
+        self.flush_interval = flush_interval
+        self.limit = limit
+
+        self.rising = rising if rising is not None else array("Q", bytes(8 * MAX_CARDS * RELAYS_PER_CARD))
+        self.falling = falling if falling is not None else array("Q", bytes(8 * MAX_CARDS * RELAYS_PER_CARD))
+        self._last_state = array("h", [-1] * MAX_CARDS) # -1: no confirmed state yet
+        self._limit_warned = set() # counter indices already reported this session
+        self.transitions = 0
+
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    def record(self, card_id: int, state: int) -> list[int]:
+        """Returns the relay indices newly found at or over the cycle limit with this state"""
+        previous = self._last_state[card_id]
+        self._last_state[card_id] = state
+
+        changed = 0 if previous < 0 else previous ^ state
+
+        # the first confirmed state checks every relay, counters may have been loaded over the limit
+        check = 0xff if previous < 0 else changed & state
+
+        if changed != 0:
+            self.transitions += bin(changed).count("1") # popcount
+            self._dirty = True
+            base = card_id * RELAYS_PER_CARD
+
+            while changed:
+                low = changed & -changed
+                i = low.bit_length() - 1
+                changed ^= low
+
+                if state & low:
+                    self.rising[base + i] += 1
+                else:
+                    self.falling[base + i] += 1
+
+        reached = self._check_limit(card_id, check)
+
+        if self._dirty and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+        return reached
+
+    def _check_limit(self, card_id, relay_flags):
+        reached = []
+        if not self.limit:
+            return reached
+
+        base = card_id * RELAYS_PER_CARD
+        for i in range(RELAYS_PER_CARD):
+            if relay_flags & (1 << i) and self.rising[base + i] >= self.limit and base + i not in self._limit_warned:
+                self._limit_warned.add(base + i)
+                log.warning(f"Card {card_id} relay {i + 1} reached {self.rising[base + i]} switch cycles (limit {self.limit})")
+                reached.append(i)
+
+        return reached
+
+    def cycles(self, card_id=0) -> list[int]:
+        """Completed on/off cycles (rising edges) per relay of one card"""
+        base = card_id * RELAYS_PER_CARD
+        return self.rising[base:base + RELAYS_PER_CARD].tolist()
+
+    def over_limit(self, card_id=0) -> list[bool]:
+        return [bool(self.limit) and c >= self.limit for c in self.cycles(card_id)]
+
+    def to_dict(self):
+        cards = {}
+        for card_id in range(MAX_CARDS):
+            base = card_id * RELAYS_PER_CARD
+            rising = self.rising[base:base + RELAYS_PER_CARD].tolist()
+            falling = self.falling[base:base + RELAYS_PER_CARD].tolist()
+
+            if any(rising) or any(falling):
+                cards[str(card_id)] = {"rising": rising, "falling": falling}
+
+        return {"cards": cards}
+
+    def load(self):
+        if not Path.is_file(self.path):
+            log.debug("No cycle counter file yet")
+            return self
+
+        with open(self.path, mode="r") as f:
+            content = json.load(f)
+
+        for card_id, counters in content.get("cards", {}).items():
+            base = int(card_id) * RELAYS_PER_CARD
+            for i in range(RELAYS_PER_CARD):
+                self.rising[base + i] = counters["rising"][i]
+                self.falling[base + i] = counters["falling"][i]
+
+        return self
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._dirty:
+            return
+
+        directory = self.path.parent
+        fd, temp_path = tempfile.mkstemp(prefix=f".{self.path.name}.", dir=directory)
+        try:
+            with os.fdopen(fd, mode="w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        self._dirty = False
+        log.debug(f"Flushed cycle counters to {self.path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show relay switch cycle counters")
+    parser.add_argument("--file", default=CYCLES_NAME, help=f"counter file (default: {CYCLES_NAME})")
+    parser.add_argument("--limit", type=int, default=None, help="mark relays with at least this many cycles")
+    args = parser.parse_args()
+
+    store = RelayCycleStore(path=args.file, limit=args.limit).load()
+    cards = store.to_dict()["cards"]
+
+    if len(cards) == 0:
+        print("No cycles recorded")
+        return
+
+    for card_id in cards:
+        for i, cycles in enumerate(store.cycles(int(card_id))):
+            marker = ""
+            if store.over_limit(int(card_id))[i]:
+                marker = "  LIMIT REACHED"
+            print(f"card {card_id} relay {i + 1}: {cycles}{marker}")
+
+
+if __name__ == "__main__":
+    main()
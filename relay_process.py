@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import multiprocessing
+import argparse
+import itertools
+import threading
+import logging
+from protocol_conrad import ConradRelayCard, ConradSerialFrame, CommandCodes, STATE_COMMANDS
+from relay_cycles import RelayCycleStore, MAX_CARDS, RELAYS_PER_CARD
+from serial_multiplexer import SerialMultiplexer, Priority, TimingStats
+__author__="Robert Detlof"
+
+log = logging.getLogger("Relay Process")
+
+
+class SharedRelayState:
+    """
+    Fixed layout in one shared memory block, written only by the I/O process:
+
+        [0]      uint64 sequence, odd while the writer is updating states
+        [8]      uint8  state byte per card address
+        [264]    uint8  1 once a card state has been confirmed
+        [520]    float64 pulse timing stats (count, mean, m2, worst)
+        [552]    uint64 rising edge counters, 8 per card
+        [16936]  uint64 falling edge counters, 8 per card
+
+    All fields are memoryviews on the block, nothing is copied on read.
+    """
+
+    _STATES = 8
+    _KNOWN = _STATES + MAX_CARDS
+    _STATS = _KNOWN + MAX_CARDS
+    _RISING = _STATS + 4 * 8
+    _FALLING = _RISING + 8 * MAX_CARDS * RELAYS_PER_CARD
+    SIZE = _FALLING + 8 * MAX_CARDS * RELAYS_PER_CARD
+
+    def __init__(self, name=None) -> None:
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=SharedRelayState.SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        buf = self.shm.buf
+        self.name = self.shm.name
+        self._sequence = buf[0:8].cast("Q")
+        self.states = buf[self._STATES:self._KNOWN]
+        self.known = buf[self._KNOWN:self._STATS]
+        self._stats = buf[self._STATS:self._RISING].cast("d")
+        self.rising = buf[self._RISING:self._FALLING].cast("Q")
+        self.falling = buf[self._FALLING:self.SIZE].cast("Q")
+
+    def publish_state(self, card_id, state):
+        self._sequence[0] += 1
+        self.states[card_id] = state
+        self.known[card_id] = 1
+        self._sequence[0] += 1
+
+    def publish_stats(self, stats: TimingStats):
+        self._stats[0] = stats.count
+        self._stats[1] = stats.mean
+        self._stats[2] = stats.m2
+        self._stats[3] = stats.worst
+
+    def read_state(self, card_id=0):
+        """Latest confirmed state byte of a card or None"""
+        while True:
+            sequence = self._sequence[0]
+            if sequence & 1:
+                continue
+
+            state = self.states[card_id]
+            known = self.known[card_id]
+
+            if self._sequence[0] == sequence:
+                return state if known else None
+
+    def read_stats(self) -> TimingStats:
+        count, mean, m2, worst = self._stats.tolist()
+        return TimingStats(int(count), mean, m2, worst)
+
+    def close(self):
+        for view in (self._sequence, self.states, self.known, self._stats, self.rising, self.falling):
+            view.release()
+
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _serve_process(conn, shm_name, cycle_path, cycle_limit):
+    shared = SharedRelayState(name=shm_name)
+    cycle_store = RelayCycleStore(path=cycle_path, limit=cycle_limit, rising=shared.rising, falling=shared.falling).load()
+    relay_card = ConradRelayCard(cycle_store=cycle_store)
+    multiplexer = SerialMultiplexer(relay_card)
+    multiplexer.start()
+
+    send_lock = threading.Lock()
+
+    def reply(request_id, ok, payload):
+        with send_lock:
+            conn.send((request_id, ok, payload))
+
+    def publish_state(request_frame, response):
+        if request_frame.get_command() in STATE_COMMANDS:
+            shared.publish_state(request_frame.address[0], response.get_data())
+
+    def on_done(request_id, request_frames, future):
+        if future.cancelled():
+            reply(request_id, False, "cancelled")
+            return
+
+        e = future.exception()
+        if e is not None:
+            reply(request_id, False, e)
+            return
+
+        result = future.result()
+        if isinstance(result, list):
+            for request_frame, report in zip(request_frames, result):
+                publish_state(request_frame, report.off_response)
+            shared.publish_stats(multiplexer.pulse_stats)
+        else:
+            publish_state(request_frames[0], result)
+
+        reply(request_id, True, result)
+
+    while True:
+        request_id, command, args = conn.recv()
+
+        if command == "stop":
+            break
+
+        if command == "connect":
+            try:
+                relay_card.connect(*args)
+                reply(request_id, True, None)
+            except Exception as e:
+                reply(request_id, False, e)
+            continue
+
+        if command == "disconnect":
+            relay_card.shutdown()
+            reply(request_id, True, None)
+            continue
+
+        if command == "pulse":
+            on_frames, off_frames, duration_ms, priority = args
+            request_frames = [ConradSerialFrame(*f) for f in on_frames]
+            off_frames = [ConradSerialFrame(*f) for f in off_frames]
+            future = multiplexer.submit_pulse(request_frames, off_frames, duration_ms, priority=priority)
+        else:
+            command_code, card_id, data, priority = args
+            request_frames = [ConradSerialFrame(command_code, card_id, data)]
+            future = multiplexer.submit(request_frames[0], priority=priority)
+
+        future.add_done_callback(lambda f, i=request_id, r=request_frames: on_done(i, r, f))
+
+    multiplexer.shutdown()
+    relay_card.shutdown()
+    reply(request_id, True, None)
+    shared.close()
+
+
+class RelayProcessClient:
+    """
+    Same interface as SerialMultiplexer, but the relay card and its
+    multiplexer live in a separate process, away from the GIL of the GUI.
+
+    Commands go over a pipe, replies resolve the returned futures in the
+    thread running serve(). Card states, cycle counters and pulse timing are
+    read straight from shared memory.
+    """
+
+    def __init__(self, cycle_path=None, cycle_limit=None) -> None:
+        self.shared = SharedRelayState()
+        self.cycle_store = RelayCycleStore(path=cycle_path, limit=cycle_limit, rising=self.shared.rising, falling=self.shared.falling)
+        self.interrupt_requested = False
+
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve_process,
+            args=(child_conn, self.shared.name, self.cycle_store.path, cycle_limit),
+            name="RelayProcess",
+            daemon=True
+            )
+        self._process.start()
+
+        self._ids = itertools.count()
+        self._pending = {}
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._serving = False
+        self._stopping = False
+
+    def _send(self, command, args=()) -> Future:
+        future = Future()
+        request_id = next(self._ids)
+        self._pending[request_id] = future
+
+        with self._send_lock:
+            self._conn.send((request_id, command, args))
+
+        return future
+
+    def submit(self, frame: ConradSerialFrame, priority=Priority.NORMAL) -> Future:
+        args = (frame.get_command(), frame.address[0], frame.get_data(), priority)
+        return self._send("frame", args)
+
+    def submit_pulse(self, on_frames: list[ConradSerialFrame], off_frames: list[ConradSerialFrame], duration_ms: int, priority=Priority.NORMAL) -> Future:
+        on_frames = [(f.get_command(), f.address[0], f.get_data()) for f in on_frames]
+        off_frames = [(f.get_command(), f.address[0], f.get_data()) for f in off_frames]
+        return self._send("pulse", (on_frames, off_frames, duration_ms, priority))
+
+    def set_relays(self, card_id=0, relay_flags=0, priority=Priority.NORMAL) -> Future:
+        request_frame = ConradSerialFrame(CommandCodes.SETPORT, card_id, relay_flags)
+        return self.submit(request_frame, priority=priority)
+
+    def enable_relays(self, card_id=0, relay_flags=0, priority=Priority.NORMAL) -> Future:
+        request_frame = ConradSerialFrame(CommandCodes.SETSINGLE, card_id, relay_flags)
+        return self.submit(request_frame, priority=priority)
+
+    def disable_relays(self, card_id=0, relay_flags=0, priority=Priority.NORMAL) -> Future:
+        request_frame = ConradSerialFrame(CommandCodes.DELSINGLE, card_id, relay_flags)
+        return self.submit(request_frame, priority=priority)
+
+    def pulse_relays(self, card_id=0, on_flags=0, off_flags=0, duration_ms=500, priority=Priority.NORMAL) -> Future:
+        return self.pulse_cards({card_id: (on_flags, off_flags)}, duration_ms, priority=priority)
+
+    def pulse_cards(self, card_flags: dict, duration_ms=500, priority=Priority.NORMAL) -> Future:
+        on_frames = [(CommandCodes.SETPORT, card_id, on) for card_id, (on, off) in card_flags.items()]
+        off_frames = [(CommandCodes.SETPORT, card_id, off) for card_id, (on, off) in card_flags.items()]
+        return self._send("pulse", (on_frames, off_frames, duration_ms, priority))
+
+    def pulse_masks(self, card_masks: dict, duration_ms=500, priority=Priority.NORMAL) -> Future:
+        on_frames = [(CommandCodes.SETSINGLE, card_id, mask) for card_id, mask in card_masks.items()]
+        off_frames = [(CommandCodes.DELSINGLE, card_id, mask) for card_id, mask in card_masks.items()]
+        return self._send("pulse", (on_frames, off_frames, duration_ms, priority))
+
+    def check_relay_state(self, card_id=0, priority=Priority.HIGH) -> Future:
+        request_frame = ConradSerialFrame(CommandCodes.GETPORT, card_id, 0)
+        return self.submit(request_frame, priority=priority)
+
+    def all_off(self, card_id=0) -> Future:
+        return self.set_relays(card_id=card_id, relay_flags=0, priority=Priority.EMERGENCY)
+
+    def connect(self, com_port, timeout=5.0):
+        self._send("connect", (com_port,)).result(timeout=timeout)
+
+    def disconnect(self, timeout=5.0):
+        self._send("disconnect").result(timeout=timeout)
+
+    def read_state(self, card_id=0):
+        return self.shared.read_state(card_id)
+
+    @property
+    def pulse_stats(self) -> TimingStats:
+        return self.shared.read_stats()
+
+    def serve(self, interrupt_requested=lambda: False):
+        self._serving = True
+        while not self.interrupt_requested and not interrupt_requested():
+            if not self._conn.poll(timeout=1.0):
+                continue
+
+            try:
+                request_id, ok, payload = self._conn.recv()
+            except EOFError:
+                if not self._stopping:
+                    log.error("Relay process exited")
+                self._fail_pending(ConnectionError("Relay process exited"))
+                break
+
+            future = self._pending.pop(request_id)
+
+            if ok:
+                future.set_result(payload)
+            elif payload == "cancelled":
+                future.cancel()
+            else:
+                future.set_exception(payload)
+
+        self._serving = False
+
+    def _fail_pending(self, e):
+        # no reply will come anymore, waiters and done callbacks must not hang
+        while len(self._pending) > 0:
+            request_id, future = self._pending.popitem()
+            if not future.done():
+                future.set_exception(e)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._thread = threading.Thread(target=self.serve, name="RelayProcessClient", daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout=5.0):
+        # replies are only read while someone serves
+        if not self._serving:
+            self.start()
+
+        self._stopping = True
+        if self._process.is_alive():
+            try:
+                self._send("stop").result(timeout=timeout)
+            except Exception as e:
+                log.error(str(e))
+
+        self.interrupt_requested = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self._process.join(timeout=timeout)
+        self.shared.close()
+
+
+def _burn_gil(stop_event):
+    # stand-in for Qt painting and logging competing for the interpreter
+    while not stop_event.is_set():
+        sum(range(10000))
+
+
+def measure_pulse_jitter(multiplexer, pulses=20, duration=500, card_id=0, relay_flags=0b11100000):
+    for _ in range(pulses):
+        future = multiplexer.pulse_relays(card_id=card_id, on_flags=relay_flags, off_flags=0, duration_ms=duration)
+        future.result(timeout=duration / 1000 + 5.0)
+
+    return multiplexer.pulse_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare pulse timing of in-process and separate-process serial I/O")
+    parser.add_argument("port", help="serial port of the relay card, e.g. COM5")
+    parser.add_argument("--pulses", type=int, default=20)
+    parser.add_argument("--duration", type=int, default=500, help="pulse duration in ms")
+    parser.add_argument("--load", action="store_true", help="keep a busy thread in the main process, like a GUI would")
+    args = parser.parse_args()
+
+    stop_event = threading.Event()
+    if args.load:
+        threading.Thread(target=_burn_gil, args=(stop_event,), daemon=True).start()
+
+    relay_card = ConradRelayCard()
+    multiplexer = SerialMultiplexer(relay_card)
+    multiplexer.connect(args.port)
+    multiplexer.start()
+    in_process = measure_pulse_jitter(multiplexer, args.pulses, args.duration)
+    multiplexer.shutdown()
+    relay_card.shutdown()
+
+    client = RelayProcessClient()
+    client.start()
+    client.connect(args.port)
+    separate_process = measure_pulse_jitter(client, args.pulses, args.duration)
+    client.shutdown()
+
+    stop_event.set()
+
+    print(f"pulse duration error, in-process:       {in_process}")
+    print(f"pulse duration error, separate process: {separate_process}")
+
+
+if __name__ == "__main__":
+    main()
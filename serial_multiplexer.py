@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+from collections import deque
+from concurrent.futures import Future
+import threading
+import math
+import time
+import logging
+from protocol_conrad import ConradSerialFrame, CommandCodes, frame_round_trip_time
+__author__="Robert Detlof"
+
+log = logging.getLogger("Serial Multiplexer")
+
+SPIN_TIME = 0.02 # last seconds before a deadline are spun instead of slept, timer resolution is too coarse
+
+
+class Priority:
+    EMERGENCY = 0
+    HIGH = 1
+    NORMAL = 2
+
+    def get_label(index):
+        label_dict = {
+            Priority.EMERGENCY: "EMERGENCY",
+            Priority.HIGH: "HIGH",
+            Priority.NORMAL: "NORMAL"
+        }
+
+        return label_dict[index]
+
+
+class TimingStats:
+    """Running mean/stdev/max of timing errors in seconds (Welford)"""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, worst=0.0) -> None:
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.worst = worst
+
+    def record(self, error: float):
+        self.count += 1
+        delta = error - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (error - self.mean)
+        self.worst = max(self.worst, abs(error))
+
+    def stdev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def __str__(self) -> str:
+        return f"n={self.count} mean={self.mean * 1000:.2f} ms stdev={self.stdev() * 1000:.2f} ms max={self.worst * 1000:.2f} ms"
+
+
+class PulseInterrupted(Exception):
+    pass
+
+
+class PulseReport:
+    def __init__(self, requested_ms: float, achieved_ms: float, on_response: ConradSerialFrame, off_response: ConradSerialFrame) -> None:
+        self.requested_ms = requested_ms
+        self.achieved_ms = achieved_ms
+        self.on_response = on_response
+        self.off_response = off_response
+
+    def error_ms(self):
+        return self.achieved_ms - self.requested_ms
+
+    def __str__(self) -> str:
+        return f"pulse requested {self.requested_ms:.1f} ms, achieved {self.achieved_ms:.1f} ms ({self.error_ms():+.1f} ms)"
+
+
+class SerialRequest:
+    def __init__(self, frames: list[ConradSerialFrame], priority: int, off_frames: list[ConradSerialFrame] = None, duration_ms: int = 0) -> None:
+        self.frames = frames
+        self.priority = priority
+        self.off_frames = off_frames
+        self.duration_ms = duration_ms
+        self.future = Future()
+
+    def __str__(self) -> str:
+        return ", ".join(str(f) for f in self.frames)
+
+
+class SerialMultiplexer:
+    """
+    Single owner of one serial link. Any thread may submit frames; only the
+    thread running serve() talks to the relay card.
+
+    submit() only appends to a per-priority deque and sets an event, so
+    producers never block on the link. An EMERGENCY submission cancels every
+    pending lower-priority request and interrupts a running pulse; the
+    emergency goes out first, then the off frames of the cards it did not
+    address.
+
+    Pulses are timed on the monotonic clock: the relays are taken to switch
+    half a measured round trip after a frame is written, and the off frame is
+    written early by the current estimate of that latency. Pulses shorter
+    than the card settle time can not be met.
+    """
+
+    def __init__(self, relay_card) -> None:
+        self.relay_card = relay_card
+        self._lanes = [deque() for _ in range(Priority.NORMAL + 1)]
+        self._wakeup = threading.Event()
+        self._preempt = threading.Event()
+        self._thread = None
+        self.interrupt_requested = False
+        self.latency = frame_round_trip_time() / 2 # estimated write-to-switch time in seconds
+        self.pulse_stats = TimingStats() # achieved minus requested pulse duration
+
+    def submit(self, frame: ConradSerialFrame, priority=Priority.NORMAL) -> Future:
+        return self._enqueue(SerialRequest([frame], priority))
+
+    def submit_pulse(self, on_frames: list[ConradSerialFrame], off_frames: list[ConradSerialFrame], duration_ms: int, priority=Priority.NORMAL) -> Future:
+        """
+        All on frames go out back to back, then every off frame at its own
+        deadline. The future resolves to one PulseReport per frame pair.
+        """
+        return self._enqueue(SerialRequest(on_frames, priority, off_frames=off_frames, duration_ms=duration_ms))
+
+    def _enqueue(self, request: SerialRequest) -> Future:
+        priority = request.priority
+        self._lanes[priority].append(request)
+
+        if priority == Priority.EMERGENCY:
+            self._cancel_pending(below=priority)
+            self._preempt.set()
+
+        self._wakeup.set()
+        return request.future
+
+    def set_relays(self, card_id=0, relay_flags=0, priority=Priority.NORMAL) -> Future:
+        request_frame = ConradSerialFrame(CommandCodes.SETPORT, card_id, relay_flags)
+        return self.submit(request_frame, priority=priority)
+
+    def enable_relays(self, card_id=0, relay_flags=0, priority=Priority.NORMAL) -> Future:
+        """Switches on the relays in relay_flags, the card keeps all others as they are"""
+        request_frame = ConradSerialFrame(CommandCodes.SETSINGLE, card_id, relay_flags)
+        return self.submit(request_frame, priority=priority)
+
+    def disable_relays(self, card_id=0, relay_flags=0, priority=Priority.NORMAL) -> Future:
+        """Switches off the relays in relay_flags, the card keeps all others as they are"""
+        request_frame = ConradSerialFrame(CommandCodes.DELSINGLE, card_id, relay_flags)
+        return self.submit(request_frame, priority=priority)
+
+    def pulse_relays(self, card_id=0, on_flags=0, off_flags=0, duration_ms=500, priority=Priority.NORMAL) -> Future:
+        return self.pulse_cards({card_id: (on_flags, off_flags)}, duration_ms, priority=priority)
+
+    def pulse_cards(self, card_flags: dict, duration_ms=500, priority=Priority.NORMAL) -> Future:
+        """card_flags maps card id to (on_flags, off_flags)"""
+        on_frames = [ConradSerialFrame(CommandCodes.SETPORT, card_id, on) for card_id, (on, off) in card_flags.items()]
+        off_frames = [ConradSerialFrame(CommandCodes.SETPORT, card_id, off) for card_id, (on, off) in card_flags.items()]
+        return self.submit_pulse(on_frames, off_frames, duration_ms, priority=priority)
+
+    def pulse_masks(self, card_masks: dict, duration_ms=500, priority=Priority.NORMAL) -> Future:
+        """card_masks maps card id to the relays to pulse, other relays are left alone"""
+        on_frames = [ConradSerialFrame(CommandCodes.SETSINGLE, card_id, mask) for card_id, mask in card_masks.items()]
+        off_frames = [ConradSerialFrame(CommandCodes.DELSINGLE, card_id, mask) for card_id, mask in card_masks.items()]
+        return self.submit_pulse(on_frames, off_frames, duration_ms, priority=priority)
+
+    def check_relay_state(self, card_id=0, priority=Priority.HIGH) -> Future:
+        request_frame = ConradSerialFrame(CommandCodes.GETPORT, card_id, 0)
+        return self.submit(request_frame, priority=priority)
+
+    def all_off(self, card_id=0) -> Future:
+        return self.set_relays(card_id=card_id, relay_flags=0, priority=Priority.EMERGENCY)
+
+    def _cancel_pending(self, below: int):
+        for lane in self._lanes[below + 1:]:
+            while True:
+                try:
+                    request = lane.popleft()
+                except IndexError:
+                    break
+
+                if request.future.cancel():
+                    log.info(f"[CANCEL] {Priority.get_label(request.priority)} {str(request)}")
+
+    def _next_request(self):
+        for lane in self._lanes:
+            try:
+                return lane.popleft()
+            except IndexError:
+                continue
+
+        return None
+
+    def _wait_until(self, deadline: float):
+        """False if an emergency request came in before the deadline"""
+        self._preempt.clear()
+
+        while True:
+            if len(self._lanes[Priority.EMERGENCY]) > 0:
+                return False
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+
+            if remaining > SPIN_TIME:
+                self._preempt.wait(timeout=remaining - SPIN_TIME)
+            else:
+                time.sleep(0)
+
+    def _transmit(self, frame: ConradSerialFrame):
+        response = self.relay_card._communicate(frame)
+
+        one_way = (response.received_at - response.sent_at) / 2
+        self.latency += 0.2 * (one_way - self.latency)
+
+        return response
+
+    def _switch_time(self, response: ConradSerialFrame):
+        return response.sent_at + (response.received_at - response.sent_at) / 2
+
+    def _serve_emergencies(self) -> set:
+        """Runs every pending emergency request, returns the card addresses they set"""
+        cards = set()
+        while True:
+            try:
+                request = self._lanes[Priority.EMERGENCY].popleft()
+            except IndexError:
+                return cards
+
+            cards.update(f.address[0] for f in request.frames)
+            self._run(request)
+
+    def _release_pulse(self, off_frames: list[ConradSerialFrame]):
+        """
+        Sends the off frames of an interrupted pulse behind the emergency
+        requests, except for cards an emergency has set already.
+        """
+        emergency_cards = set()
+        for off_frame in off_frames:
+            emergency_cards |= self._serve_emergencies()
+            if off_frame.address[0] in emergency_cards:
+                continue
+
+            try:
+                self._transmit(off_frame)
+            except Exception as e:
+                log.error(f"Could not release card {off_frame.address[0]} after interrupted pulse: {e}")
+
+    def _pulse(self, request: SerialRequest) -> list[PulseReport]:
+        on_responses = [self._transmit(f) for f in request.frames]
+
+        reports = []
+        for i, (on_response, off_frame) in enumerate(zip(on_responses, request.off_frames)):
+            switched_on = self._switch_time(on_response)
+
+            off_deadline = switched_on + request.duration_ms / 1000
+            if not self._wait_until(off_deadline - self.latency):
+                self._release_pulse(request.off_frames[i:])
+                raise PulseInterrupted("Pulse pre-empted by emergency request")
+
+            off_response = self._transmit(off_frame)
+            switched_off = self._switch_time(off_response)
+
+            report = PulseReport(request.duration_ms, (switched_off - switched_on) * 1000, on_response, off_response)
+            self.pulse_stats.record(report.error_ms() / 1000)
+            log.info(f"[PULSE] {report}")
+            reports.append(report)
+
+        return reports
+
+    def serve(self, interrupt_requested=lambda: False):
+        while not self.interrupt_requested and not interrupt_requested():
+            request = self._next_request()
+
+            if request is None:
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+
+            self._run(request)
+
+        self._cancel_pending(below=-1)
+
+    def _run(self, request: SerialRequest):
+        if not request.future.set_running_or_notify_cancel():
+            return
+
+        try:
+            if request.off_frames is None:
+                result = self._transmit(request.frames[0])
+            else:
+                result = self._pulse(request)
+        except Exception as e:
+            log.error(str(e))
+            request.future.set_exception(e)
+            return
+
+        request.future.set_result(result)
+
+    def connect(self, com_port):
+        self.relay_card.connect(com_port)
+
+    def disconnect(self):
+        self.relay_card.shutdown()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self.interrupt_requested = False
+        self._thread = threading.Thread(target=self.serve, name="SerialMultiplexer", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self.interrupt_requested = True
+        self._wakeup.set()
+        self._preempt.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import numpy as np # pip install numpy
+import logging
+from protocol_conrad import ConradSerialFrame, CommandCodes, frame_round_trip_time, SETTLE_TIME
+__author__="Robert Detlof"
+
+log = logging.getLogger("Timeline Compiler")
+
+MAX_TIMELINE_MS = 86400000 # same upper bound as a button "duration" in the relay config
+RELAYS_PER_CARD = 8
+
+# Timelines are given per card and per relay number (1-8, as in the config targets):
+#
+#     {
+#         card_id: {
+#             relay_number: [segment, ...]
+#         }
+#     }
+#
+# A segment is one of
+#
+#     {"start": 0, "stop": 3600000, "period": 1000, "duty": 0.25, "phase": 100}
+#     {"start": 0, "stop": 5000}                    # on for the whole segment
+#     {"intervals": [[0, 500], [1500, 2000], ...]}  # explicit on/off periods
+#
+# A relay is on whenever at least one of its segments is on. All times are ms.
+
+
+class LinkBudgetError(Exception):
+    pass
+
+
+class CompiledSchedule:
+    def __init__(self, times_ms, card_ids, data, frame_cost_ms, max_lag_ms) -> None:
+        self.times_ms = times_ms
+        self.card_ids = card_ids
+        self.data = data
+        self.frame_cost_ms = frame_cost_ms
+        self.max_lag_ms = max_lag_ms
+
+    def __len__(self):
+        return len(self.times_ms)
+
+    def duration_ms(self):
+        if len(self.times_ms) == 0:
+            return 0
+        return int(self.times_ms[-1] - self.times_ms[0])
+
+    def frames(self):
+        for t, card_id, data in zip(self.times_ms.tolist(), self.card_ids.tolist(), self.data.tolist()):
+            yield t, ConradSerialFrame(CommandCodes.SETPORT, card_id, data)
+
+    def __str__(self) -> str:
+        return f"{len(self)} frames over {self.duration_ms()} ms, max lag {self.max_lag_ms:.1f} ms at {self.frame_cost_ms:.1f} ms/frame"
+
+
+def _check_time(value, name):
+    if value < 0 or value > MAX_TIMELINE_MS:
+        raise ValueError(f"Timeline {name} {value} out of range [0-{MAX_TIMELINE_MS}]")
+
+
+def _segment_edges(segment):
+    """Returns (rises, falls) as int64 arrays of the on-intervals of one segment"""
+    if "intervals" in segment:
+        intervals = np.asarray(segment["intervals"], dtype=np.int64).reshape(-1, 2)
+        if len(intervals) > 0:
+            _check_time(intervals.min(), "interval edge")
+            _check_time(intervals.max(), "interval edge")
+        return intervals[:, 0], intervals[:, 1]
+
+    start = int(segment.get("start", 0))
+    stop = int(segment["stop"])
+    _check_time(start, "start")
+    _check_time(stop, "stop")
+
+    period = segment.get("period")
+    if period is None:
+        return np.array([start], dtype=np.int64), np.array([stop], dtype=np.int64)
+
+    period = int(period)
+    duty = float(segment.get("duty", 0.5))
+    if period < 1:
+        raise ValueError(f"Timeline period {period} must be at least 1 ms")
+    if duty < 0 or duty > 1:
+        raise ValueError(f"Timeline duty {duty} out of range [0-1]")
+
+    on_time = int(round(duty * period))
+    phase = int(segment.get("phase", 0)) % period
+
+    # one extra cycle in front catches an on-time reaching into the segment start
+    rises = np.arange(start + phase - period, stop, period, dtype=np.int64)
+    falls = rises + on_time
+
+    return np.maximum(rises, start), np.minimum(falls, stop)
+
+
+def _relay_edges(segments):
+    edges = [_segment_edges(s) for s in segments]
+    if len(edges) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    rises = np.concatenate([e[0] for e in edges])
+    falls = np.concatenate([e[1] for e in edges])
+
+    keep = falls > rises
+    return rises[keep], falls[keep]
+
+
+def compile_timelines(timelines: dict, frame_cost_ms=None, max_lag_ms=None) -> CompiledSchedule:
+    """
+    Compiles per-relay timelines of several cards on one serial link into a
+    time-ordered list of SETPORT frames.
+
+    Every card gets a frame at t=0 and after that only when its byte changes.
+    Raises LinkBudgetError when frames would queue up on the link for more
+    than max_lag_ms. The default allows one frame slot per card, i.e. one
+    frame for every card due at the same time, as at t=0.
+    """
+    card_ids = np.array(sorted(timelines), dtype=np.uint8)
+
+    if frame_cost_ms is None:
+        frame_cost_ms = (frame_round_trip_time() + SETTLE_TIME) * 1000
+    if max_lag_ms is None:
+        max_lag_ms = frame_cost_ms * max(1, len(card_ids))
+
+    relay_edges = []
+    for card_index, card_id in enumerate(card_ids.tolist()):
+        for relay_number, segments in timelines[card_id].items():
+            if relay_number < 1 or relay_number > RELAYS_PER_CARD:
+                raise ValueError(f"Relay number {relay_number} out of range [1-{RELAYS_PER_CARD}]")
+            rises, falls = _relay_edges(segments)
+            relay_edges.append((card_index, relay_number - 1, rises, falls))
+
+    change_points = np.concatenate(
+        [np.zeros(1, dtype=np.int64)] + [e[2] for e in relay_edges] + [e[3] for e in relay_edges]
+    )
+    change_points.sort()
+    change_points = change_points[np.concatenate(([True], change_points[1:] != change_points[:-1]))]
+    n_points = len(change_points)
+
+    card_bytes = np.zeros((len(card_ids), n_points), dtype=np.uint8)
+
+    for card_index, bit, rises, falls in relay_edges:
+        # +1 at every rise, -1 at every fall, overlapping segments simply stack
+        delta = np.bincount(np.searchsorted(change_points, rises), minlength=n_points).astype(np.int64)
+        delta -= np.bincount(np.searchsorted(change_points, falls), minlength=n_points)
+        on = np.cumsum(delta) > 0
+        card_bytes[card_index] |= on.astype(np.uint8) << bit
+
+    # drop frames that would not change the card
+    changed = np.empty(card_bytes.shape, dtype=bool)
+    changed[:, 0] = True
+    np.not_equal(card_bytes[:, 1:], card_bytes[:, :-1], out=changed[:, 1:])
+
+    point_index, card_index = np.nonzero(changed.T) # time major, cards in address order
+    times_ms = change_points[point_index]
+
+    lag = _link_lag(times_ms, frame_cost_ms)
+    worst_lag = float(lag.max()) if len(lag) > 0 else 0.0
+
+    schedule = CompiledSchedule(times_ms, card_ids[card_index], card_bytes[card_index, point_index], frame_cost_ms, worst_lag)
+    log.info(f"Compiled {schedule}")
+
+    if worst_lag > max_lag_ms:
+        first = int(np.argmax(lag > max_lag_ms))
+        raise LinkBudgetError(f"Frame at {int(times_ms[first])} ms would be sent {float(lag[first]):.1f} ms late (allowed {max_lag_ms:.1f} ms at {frame_cost_ms:.1f} ms/frame)")
+
+    return schedule
+
+
+def _link_lag(times_ms, frame_cost_ms):
+    """
+    How late each frame goes out when every frame occupies the link for
+    frame_cost_ms: send_i = max(t_i, send_(i-1) + cost), solved as a running max.
+    """
+    slots = np.arange(len(times_ms)) * frame_cost_ms
+    send_ms = slots + np.maximum.accumulate(times_ms - slots)
+    return send_ms - times_ms